@@ -1,15 +1,92 @@
 # Copyright 2020 Oath Inc. Licensed under the terms of the Apache 2.0 license. See LICENSE in the project root.
 import boto3
+import functools
+import itertools
 import json
 import logging
+import math
 import urllib3
 import os
+import sys
+import time
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import Future, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple, Union
 from urllib3.exceptions import TimeoutError, HTTPError
 
 logging.basicConfig(format='%(asctime)s\t%(levelname)s\t%(message)s')
 log = logging.getLogger('vespa_cloudwatch_emitter')
 log.setLevel(logging.INFO)
 
+# Kept at module scope so that warm Lambda containers reuse them across invocations
+_clients: Dict[Tuple[str, Optional[str]], Any] = {}
+_cert_key_pairs: Dict[Tuple[str, str, str], Tuple[float, Dict[str, str]]] = {}
+_http_pools: Dict[Tuple[str, str], urllib3.PoolManager] = {}
+
+# Cloudwatch rejects metric values outside of -2^360 to 2^360
+_MAX_METRIC_VALUE = 2 ** 360
+
+
+def _get_client(service_name, region_name=None):
+    """
+    Returns a cached boto3 client, creating it on first use.
+    """
+    key = (service_name, region_name)
+    if key not in _clients:
+        _clients[key] = boto3.client(service_name, region_name)
+    return _clients[key]
+
+
+@functools.lru_cache(maxsize=512)
+def _dimensions_for(dimension_items: Tuple[Tuple[str, Any], ...]) -> List[dict]:
+    """
+    Returns the CloudWatch dimensions for the given (name, value) pairs. Metrics elements
+    with the same dimensions share the returned list, so it must not be modified.
+    """
+    dimensions = []
+    for dim, dim_val in dimension_items:
+        # Dimension values like host names repeat across most metrics elements,
+        # but unlike keys they are not shared by the json parser
+        if isinstance(dim_val, str):
+            dim_val = sys.intern(dim_val)
+        dimensions.append({'Name': dim,
+                           'Value': dim_val})
+    return dimensions
+
+
+def _is_valid_metric_value(value: Any) -> bool:
+    """
+    Returns whether value is a number within the range Cloudwatch accepts.
+    Python ints cannot be NaN or infinite, but may be too large to convert to float.
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return False
+    if isinstance(value, float) and not math.isfinite(value):
+        return False
+    return abs(value) <= _MAX_METRIC_VALUE
+
+
+
+class Metric:
+    """
+    One CloudWatch MetricDatum. Uses __slots__ to keep the per-metric
+    footprint small until the metric is emitted.
+    """
+    __slots__ = ('MetricName', 'Value', 'Unit', 'Dimensions')
+
+    def __init__(self, name: str, value: Union[int, float], unit: str, dimensions: List[dict]):
+        self.MetricName = name
+        self.Value = value
+        self.Unit = unit
+        self.Dimensions = dimensions
+
+    def to_dict(self) -> dict:
+        return {'MetricName': self.MetricName,
+                'Value': self.Value,
+                'Unit': self.Unit,
+                'Dimensions': self.Dimensions}
+
 
 class VespaCloudwatchEmitter:
 
@@ -25,7 +102,12 @@ class VespaCloudwatchEmitter:
         self.METRICS_API = 'metrics/v2/values?consumer=' + os.environ.get('CONSUMER', 'default')
 
         # Vespa constants
-        self.CHUNK_SIZE = 20
+        # PutMetricData accepts up to 1000 metrics per request, but payloads are limited to 1 MB.
+        # With the query protocol a metric with the maximum of 30 dimensions takes about 4 KB,
+        # so 150 metrics stay below the limit while still saving most of botocore's per-call overhead.
+        self.CHUNK_SIZE = 150
+        self.MAX_WORKERS = 8
+        self.CERT_TTL_SECONDS = 3600
 
     def run(self):
         self.chunks_sent = 0
@@ -33,7 +115,7 @@ class VespaCloudwatchEmitter:
         log.info('Retrieving Vespa metrics from {}'.format(vespa_url))
         try:
             metrics_json = self._get_metrics_json(vespa_url)
-            log.debug("json: {}".format(metrics_json))
+            log.debug("json: %s", metrics_json)
             if 'nodes' not in metrics_json:
                 log.warning("No 'nodes' in metrics json")
                 return
@@ -48,19 +130,54 @@ class VespaCloudwatchEmitter:
             log.warning("Unexpected error: {}".format(e))
 
     def _emit_metric_data(self, metric_data):
-        """ Emit metric data in chunks of max CHUNK_SIZE metrics each
+        """ Emit metric data in chunks of max CHUNK_SIZE metrics each,
+        with up to MAX_WORKERS chunks in flight at a time
+        """
+        cloudwatch = _get_client('cloudwatch')
+        log.info("Emitting metrics in chunks of max {}".format(self.CHUNK_SIZE))
+        metrics_sent = 0
+        with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
+            chunks = self.split_list(metric_data, self.CHUNK_SIZE)
+            pending: Set[Future] = set()
+            while True:
+                # Wait for a free slot before cutting the next chunk, so at most MAX_WORKERS are held
+                if len(pending) >= self.MAX_WORKERS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    metrics_sent += self._count_emitted(done)
+                chunk = next(chunks, None)
+                if chunk is None:
+                    break
+                pending.add(executor.submit(self._emit_chunk, cloudwatch, chunk))
+            metrics_sent += self._count_emitted(wait(pending).done)
+        log.info("Emitted {} metrics".format(metrics_sent))
+
+    def _emit_chunk(self, client, chunk):
         """
-        cloudwatch = boto3.client('cloudwatch')
-        log.info("Emitting {} metrics in chunks of max {}".format(len(metric_data), self.CHUNK_SIZE))
-        metric_data_chunks = self.split_list(metric_data, self.CHUNK_SIZE)
-        for chunk in metric_data_chunks:
-            log.info("Emitting chunk with {} metrics".format(len(chunk)))
-            response = self._emit_to_cloudwatch(cloudwatch, chunk)
-            self.chunks_sent += 1
-            log.info(response)
+        Emits one chunk of metric data, and returns the number of metrics emitted.
+        A failing chunk is logged and does not abort the other chunks.
+        """
+        log.info("Emitting chunk with %d metrics", len(chunk))
+        try:
+            response = self._emit_to_cloudwatch(client, chunk)
+        except (ClientError, BotoCoreError) as e:
+            log.warning("Could not emit chunk with %d metrics: %s", len(chunk), e)
+            return 0
+        log.debug("Cloudwatch response: %r", response)
+        return len(chunk)
+
+    def _count_emitted(self, futures):
+        metrics_emitted = 0
+        for future in futures:
+            emitted = future.result()
+            if emitted:
+                self.chunks_sent += 1
+                metrics_emitted += emitted
+        return metrics_emitted
 
     def _emit_to_cloudwatch(self, client, metric_data):
-        response = client.put_metric_data(MetricData=metric_data, Namespace=self.CLOUDWATCH_NAMESPACE)
+        # botocore only accepts dicts, so these are built per chunk just before sending
+        response = client.put_metric_data(MetricData=[metric.to_dict() for metric in metric_data],
+                                          Namespace=self.CLOUDWATCH_NAMESPACE)
         return response
 
     def _get_metrics_json(self, url):
@@ -69,114 +186,140 @@ class VespaCloudwatchEmitter:
         log.info("Sending request to {}".format(url))
         cert_key_pair = self._write_cert_key_pair()
         http = self._get_http(cert_key_pair)
-        response = http.request('GET', url)
-        return json.loads(response.data.decode('utf-8'))
+        # urllib3 decompresses the response body, as decode_content is enabled by default
+        response = http.request('GET', url, headers={'Accept-Encoding': 'gzip'})
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('application/json'):
+            log.warning("Unexpected content type '{}' with status {} from metrics api: {}"
+                        .format(content_type, response.status, response.data[:200]))
+            return {}
+        return json.loads(response.data)
 
     def _get_http(self, cert):
-        return urllib3.PoolManager(cert_file=cert[self.CERT_NAME],
-                                   cert_reqs='CERT_REQUIRED',
-                                   key_file=cert[self.KEY_NAME],
-                                   timeout=urllib3.Timeout(connect=5.0, read=240.0))
+        """
+        Returns a PoolManager for the given cert/key paths, reused across invocations
+        so that warm Lambda containers can keep the TLS connection to Vespa alive.
+        """
+        key = (cert[self.CERT_NAME], cert[self.KEY_NAME])
+        if key not in _http_pools:
+            _http_pools[key] = urllib3.PoolManager(cert_file=cert[self.CERT_NAME],
+                                                   cert_reqs='CERT_REQUIRED',
+                                                   key_file=cert[self.KEY_NAME],
+                                                   timeout=urllib3.Timeout(connect=5.0, read=240.0))
+        return _http_pools[key]
 
     def _write_cert_key_pair(self):
         """
-        Retrieves application certificate and key stored in SSM parameter store, and writes result to /tmp/
+        Retrieves application certificate and key stored in SSM parameter store, and writes result to /tmp/.
+        The result is reused for CERT_TTL_SECONDS as long as the written files still exist.
         :return: Dictionary (key: cert/key name, value: cert/key path)
         """
-        ssm = boto3.client('ssm', self.SSM_REGION)
-        response = ssm.get_parameters(
-            Names=[self.CERT_NAME, self.KEY_NAME], WithDecryption=True
-        )
+        key = (self.SSM_REGION, self.CERT_NAME, self.KEY_NAME)
+        if key in _cert_key_pairs:
+            written_at, paths = _cert_key_pairs[key]
+            if (time.monotonic() - written_at < self.CERT_TTL_SECONDS
+                    and all(os.path.exists(path) for path in paths.values())):
+                return paths
+
         paths = {}
-        for parameter in response['Parameters']:
+        for parameter in self._get_cert_key_parameters():
             parameter_name = parameter["Name"]
             path = "/tmp/" + parameter_name
             self._write_file(path, parameter["Value"])
             paths[parameter_name] = path
+        # SSM leaves out parameters it cannot find, so only cache a complete pair
+        if self.CERT_NAME in paths and self.KEY_NAME in paths:
+            _cert_key_pairs[key] = (time.monotonic(), paths)
         return paths
 
+    def _get_cert_key_parameters(self):
+        ssm = _get_client('ssm', self.SSM_REGION)
+        response = ssm.get_parameters(
+            Names=[self.CERT_NAME, self.KEY_NAME], WithDecryption=True
+        )
+        return response['Parameters']
+
     def _write_file(self, path, content):
-        f = open(path, "w")
-        f.write(content)
-        f.close()
+        path = Path(path)
+        # After the cert TTL expires the parameters are usually unchanged, so skip rewriting them
+        if path.exists() and path.read_text() == content:
+            return
+        # Created as only readable by the owner before writing, as this is used for the private key
+        path.touch(mode=0o600)
+        path.write_text(content)
 
-    def all_metric_data_for_response(self, response_json):
-        metric_data = []
+    def all_metric_data_for_response(self, response_json: dict) -> Iterator[Metric]:
+        """
+        Yields MetricsData for all nodes in the response. The whole chain is made
+        of generators, so metrics flow straight into the chunks sent to Cloudwatch.
+        """
         for nodes_elem in response_json['nodes']:
             # Using dict.get() to avoid exception if non-existent
-            log.info("Parsing metrics from node {}".format(nodes_elem.get('hostname')))
+            log.info("Parsing metrics from node %s", nodes_elem.get('hostname'))
 
-            metric_data.extend(self._metric_data_for_node_node(nodes_elem))
-            metric_data.extend(self._metric_data_for_node_services(nodes_elem))
-        return metric_data
+            yield from self._metric_data_for_node_node(nodes_elem)
+            yield from self._metric_data_for_node_services(nodes_elem)
 
-    def _metric_data_for_node_node(self, nodes_elem):
+    def _metric_data_for_node_node(self, nodes_elem: dict) -> Iterator[Metric]:
         """
-        Returns a list of MetricsData for the 'node' (= node metrics) element
+        Yields MetricsData for the 'node' (= node metrics) element
         for a Vespa node (here represented by nodes_elem).
         """
         if 'node' not in nodes_elem:
-            log.info("No node metrics for node {} (this is expected for self-hosted Vespa)."
-                         .format(nodes_elem.get('hostname')))
-            return []
-        return self._metric_data_for_service_or_node(nodes_elem['node'])
+            log.info("No node metrics for node %s (this is expected for self-hosted Vespa).",
+                     nodes_elem.get('hostname'))
+            return
+        yield from self._metric_data_for_service_or_node(nodes_elem['node'])
 
-    def _metric_data_for_node_services(self, nodes_elem):
+    def _metric_data_for_node_services(self, nodes_elem: dict) -> Iterator[Metric]:
         """
-        Returns a list of MetricsData for all elements in the 'services'
+        Yields MetricsData for all elements in the 'services'
         list for a Vespa node (here represented by nodes_elem).
         """
         if 'services' not in nodes_elem:
-            log.warning("No services for node {}".format(nodes_elem.get('hostname')))
-            return []
+            log.warning("No services for node %s", nodes_elem.get('hostname'))
+            return
 
-        metric_data = []
         for service in nodes_elem['services']:
-            metric_data.extend(self._metric_data_for_service_or_node(service))
-        return metric_data
+            yield from self._metric_data_for_service_or_node(service)
 
-    def _metric_data_for_service_or_node(self, service_or_node):
+    def _metric_data_for_service_or_node(self, service_or_node: dict) -> Iterator[Metric]:
         """
-        Returns a list of MetricsData for all elements in the 'metrics' json
+        Yields MetricsData for all elements in the 'metrics' json
         list of a 'nodes' element's 'node' element or one of the elements
         in a node's 'services' list.
         """
         if 'metrics' not in service_or_node:
-            return []
-        metric_data = []
+            return
         for metrics_elem in service_or_node['metrics']:
-            metric_data.extend(self._get_metrics_with_dimensions(metrics_elem))
-        return metric_data
+            yield from self._get_metrics_with_dimensions(metrics_elem)
 
-    def _get_metrics_with_dimensions(self, metrics_elem):
+    def _get_metrics_with_dimensions(self, metrics_elem: dict) -> Iterator[Metric]:
         """
-        Returns a list of MetricsData for one element in a 'metrics' json list.
+        Yields MetricsData for one element in a 'metrics' json list.
         """
         if 'values' not in metrics_elem:
-            return []
-        metric_data = []
+            return
         dimensions = self._get_dimensions(metrics_elem)
         for name, value in metrics_elem['values'].items():
-            metric_data.append({'MetricName': name,
-                                'Value': value,
-                                'Unit': 'None',
-                                'Dimensions': dimensions})
-        return metric_data
-
-    def _get_dimensions(self, metrics):
-        dimensions = []
-        if 'dimensions' in metrics:
-            dimensions_json = metrics['dimensions']
-            for dim, dim_val in dimensions_json.items():
-                dimensions.append({'Name': dim,
-                                   'Value': dim_val})
-        return dimensions
-
-    def split_list(self, lst, chunk_size):
-        """
-        Splits the given list into chunks and returns the result as a list of lists/chunks
-        """
-        return [lst[i:i + chunk_size] for i in range(0, len(lst), chunk_size)]
+            # Cloudwatch rejects the whole request if any value is not a number it accepts
+            if not _is_valid_metric_value(value):
+                log.debug("Skipping metric %s with a value Cloudwatch does not accept", name)
+                continue
+            yield Metric(name, value, 'None', dimensions)
+
+    def _get_dimensions(self, metrics: dict) -> List[dict]:
+        if 'dimensions' not in metrics:
+            return []
+        return _dimensions_for(tuple(metrics['dimensions'].items()))
+
+    def split_list(self, iterable, chunk_size):
+        """
+        Splits the given iterable into chunks and yields each chunk as a list
+        """
+        iterator = iter(iterable)
+        while chunk := list(itertools.islice(iterator, chunk_size)):
+            yield chunk
 
 
 def lambda_handler(event, context):
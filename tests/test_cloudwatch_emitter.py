@@ -1,7 +1,11 @@
 # Copyright 2020 Oath Inc. Licensed under the terms of the Apache 2.0 license. See LICENSE in the project root.
+from botocore.exceptions import ClientError, EndpointConnectionError
 from cloudwatch import VespaCloudwatchEmitter
+from cloudwatch.vespa_cloudwatch_emitter import Metric
 import os
 import json
+import stat
+import uuid
 import unittest
 from mock import MagicMock
 
@@ -19,9 +23,68 @@ class TestMetricsEmitter(unittest.TestCase):
         emitter.run()
         assert emitter.chunks_sent == 3
     
+    def test_failing_chunk_does_not_abort_emission(self):
+        emitter = MockedCloudwatchEmitter()
+        with open(os.path.join(HERE, 'metrics.json'), 'r') as f:
+            emitter._get_metrics_json = MagicMock(return_value=json.load(f))
+
+        def emit_to_cloudwatch(client, metric_data):
+            if metric_data[0].MetricName == 'cpu.util':
+                raise ClientError({'Error': {'Code': 'Throttling'}}, 'PutMetricData')
+            if metric_data[0].MetricName == 'net.out.bytes':
+                raise EndpointConnectionError(endpoint_url='https://monitoring.us-east-1.amazonaws.com')
+            return 'Successfully emitted metrics'
+        emitter._emit_to_cloudwatch = MagicMock(side_effect=emit_to_cloudwatch)
+        emitter.CHUNK_SIZE = 3
+        emitter.run()
+        assert emitter._emit_to_cloudwatch.call_count == 3
+        assert emitter.chunks_sent == 1
+    
+    def test_cert_key_pair_is_reused(self):
+        emitter = MockedCloudwatchEmitter()
+        emitter.CERT_NAME = 'test-cert-' + str(uuid.uuid4())
+        emitter.KEY_NAME = 'test-key-' + str(uuid.uuid4())
+        emitter._get_cert_key_parameters = MagicMock(return_value=[
+            {'Name': emitter.CERT_NAME, 'Value': 'cert'},
+            {'Name': emitter.KEY_NAME, 'Value': 'key'}])
+        paths = emitter._write_cert_key_pair()
+        try:
+            assert emitter._write_cert_key_pair() == paths
+            assert emitter._get_cert_key_parameters.call_count == 1
+            assert stat.S_IMODE(os.stat(paths[emitter.KEY_NAME]).st_mode) == 0o600
+
+            os.remove(paths[emitter.KEY_NAME])
+            emitter._write_cert_key_pair()
+            assert emitter._get_cert_key_parameters.call_count == 2
+            assert stat.S_IMODE(os.stat(paths[emitter.KEY_NAME]).st_mode) == 0o600
+            with open(paths[emitter.KEY_NAME]) as f:
+                assert f.read() == 'key'
+        finally:
+            for path in paths.values():
+                os.remove(path)
+
+        # A pair missing the key parameter is not cached, so a fixed configuration is picked up
+        emitter.KEY_NAME = 'test-key-' + str(uuid.uuid4())
+        emitter._get_cert_key_parameters.reset_mock()
+        paths = emitter._write_cert_key_pair()
+        try:
+            assert emitter.KEY_NAME not in paths
+            emitter._write_cert_key_pair()
+            assert emitter._get_cert_key_parameters.call_count == 2
+        finally:
+            for path in paths.values():
+                os.remove(path)
+    
+    def test_non_json_response_is_not_parsed(self):
+        emitter = MockedCloudwatchEmitter()
+        emitter._write_cert_key_pair = MagicMock(return_value={})
+        response = MagicMock(status=500, headers={'Content-Type': 'text/html'}, data=b'<html>Error</html>')
+        emitter._get_http = MagicMock(return_value=MagicMock(**{'request.return_value': response}))
+        assert emitter._get_metrics_json(emitter.VESPA_ENDPOINT + emitter.METRICS_API) == {}
+    
     def test_split_list(self):
         lst = list(range(1, 11))
-        list_of_chunks = MockedCloudwatchEmitter().split_list(lst, 3)
+        list_of_chunks = list(MockedCloudwatchEmitter().split_list(lst, 3))
     
         assert len(list_of_chunks) == 4
         assert list_of_chunks[0] == [1, 2, 3]
@@ -29,7 +92,7 @@ class TestMetricsEmitter(unittest.TestCase):
     
     def test_split_list_with_only_one_chunk(self):
         lst = list(range(1, 3))
-        list_of_chunks = MockedCloudwatchEmitter().split_list(lst, 3)
+        list_of_chunks = list(MockedCloudwatchEmitter().split_list(lst, 3))
     
         assert len(list_of_chunks) == 1
         assert list_of_chunks[0] == [1, 2]
@@ -38,40 +101,63 @@ class TestMetricsEmitter(unittest.TestCase):
         emitter = MockedCloudwatchEmitter()
         with open(os.path.join(HERE, 'metrics.json'), 'r') as f:
             response = json.load(f)
-        metric_data = emitter.all_metric_data_for_response(response)
+        metric_data = list(emitter.all_metric_data_for_response(response))
         assert len(metric_data) == 8
     
         cpu_util = metric_data[0]
-        assert cpu_util['MetricName'] == 'cpu.util'
-        assert cpu_util['Value'] == 11.1
+        assert cpu_util.MetricName == 'cpu.util'
+        assert cpu_util.Value == 11.1
     
-        cpu_dimensions = cpu_util['Dimensions']
+        cpu_dimensions = cpu_util.Dimensions
         assert len(cpu_dimensions) == 4
         assert cpu_dimensions[2]['Name'] == 'host'
         assert cpu_dimensions[2]['Value'] == 'host1'
     
         net_in_bytes = metric_data[2]
-        assert net_in_bytes['MetricName'] == 'net.in.bytes'
-        assert net_in_bytes['Value'] == 12345
+        assert net_in_bytes.MetricName == 'net.in.bytes'
+        assert net_in_bytes.Value == 12345
     
         http_status = metric_data[4]
-        assert http_status['MetricName'] == 'http.status.2xx.rate'
-        assert http_status['Value'] == 4.95
+        assert http_status.MetricName == 'http.status.2xx.rate'
+        assert http_status.Value == 4.95
     
-        http_dimensions = http_status['Dimensions']
+        http_dimensions = http_status.Dimensions
         assert len(http_dimensions) == 6
         assert http_dimensions[5]['Name'] == 'httpMethod'
         assert http_dimensions[5]['Value'] == 'GET'
     
         mem_util = metric_data[7]
-        assert mem_util['MetricName'] == 'mem.util'
-        assert mem_util['Value'] == 62
+        assert mem_util.MetricName == 'mem.util'
+        assert mem_util.Value == 62
     
-        mem_dimensions = mem_util['Dimensions']
+        mem_dimensions = mem_util.Dimensions
         assert len(mem_dimensions) == 4
         assert mem_dimensions[2]['Name'] == 'host'
         assert mem_dimensions[2]['Value'] == 'host2'
 
+        # Metrics elements with identical dimensions share one dimensions list
+        assert metric_data[2].Dimensions is cpu_dimensions
+
+    def test_non_finite_values_are_skipped(self):
+        emitter = MockedCloudwatchEmitter()
+        response = json.loads('{"nodes": [{"node": {"metrics": [{"values": '
+                              '{"a": NaN, "b": Infinity, "c": -Infinity, "d": 1.5, '
+                              '"e": null, "f": "s", "g": true, "h": 2, '
+                              '"i": 1' + '0' * 400 + ', "j": 1e200}}]}}]}')
+        metric_data = list(emitter.all_metric_data_for_response(response))
+        assert [metric.MetricName for metric in metric_data] == ['d', 'h']
+
+    def test_metrics_are_emitted_as_dicts(self):
+        emitter = MockedCloudwatchEmitter()
+        emitter.CLOUDWATCH_NAMESPACE = 'my-cloudwatch-namespace'
+        client = MagicMock()
+        dimensions = [{'Name': 'host', 'Value': 'host1'}]
+        emitter._emit_to_cloudwatch(client, [Metric('cpu.util', 18.7, 'None', dimensions)])
+
+        client.put_metric_data.assert_called_once_with(
+            MetricData=[{'MetricName': 'cpu.util', 'Value': 18.7, 'Unit': 'None', 'Dimensions': dimensions}],
+            Namespace='my-cloudwatch-namespace')
+
     def test_synthetic_metric_data(self):
         """
         Included to show the format that should be emitted to Cloudwatch
@@ -97,6 +183,8 @@ class MockedCloudwatchEmitter(VespaCloudwatchEmitter):
         self.SSM_REGION = "us-east-1"
         self.METRICS_API = 'metrics/v2/values'
         self.CHUNK_SIZE = 20
+        self.MAX_WORKERS = 8
+        self.CERT_TTL_SECONDS = 3600
 
 def synthetic_metric_data():
     return [